@@ -1 +1,2 @@
-from .firestore4kivy import Authorize, Firestore, GeoPoint, TimeStamp, Reference
+from .firestore4kivy import Authorize, Firestore, FirestoreAsync, GeoPoint,\
+    TimeStamp, Reference
@@ -1,7 +1,36 @@
+import asyncio
+import gzip
 import json
 import requests
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import islice
+from random import uniform
+from re import fullmatch
+from threading import Condition, Lock, RLock
+from requests.adapters import HTTPAdapter
 from requests.exceptions import Timeout
-from time import sleep
+from time import monotonic, sleep
+from weakref import WeakValueDictionary
+
+# orjson is optional, if available it is used for JSON on the wire.
+try:
+    import orjson
+    _dumps = orjson.dumps
+    _loads = orjson.loads
+except ImportError:
+    orjson = None
+    def _dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+    _loads = json.loads
+
+# httpx with h2 is optional, if available Firestore requests are multiplexed
+# over an HTTP/2 connection.
+try:
+    import httpx
+    import h2
+except ImportError:
+    httpx = None
 
 ####### Identity Toolkit Reference
 # v1   https://cloud.google.com/identity-platform/docs/use-rest-api
@@ -15,7 +44,8 @@ from time import sleep
 
 #######
 # Implements:
-# Authorize, Firestore, GeoPoint, TimeStamp, and Reference classes.
+# Authorize, Firestore, FirestoreAsync, GeoPoint, TimeStamp, and Reference
+# classes.
 #######
 
 
@@ -26,40 +56,55 @@ class Authorize:
     def __init__(self, apikey):
         self.apikey = apikey
         self.timeout = 6.01
+        self.session = new_session()
+        # The latest sign in, see get_id_token()
+        self.local_id = ''
+        self._id_token = ''
+        self._refresh_token = ''
+        self._token_expiry = 0
+        self._token_lock = RLock()
+        # Why get_id_token() last returned '', or ''
+        self.token_error = ''
+
+    def close(self):
+        # Release the connection pool.
+        self.session.close()
 
     def create_user_with_email(self, email, password):
-        payload = json.dumps({'email': email, 'password': password,
-                              'returnSecureToken': 'true'})
+        payload = _dumps({'email': email, 'password': password,
+                          'returnSecureToken': 'true'})
         url = self.V3 + 'signupNewUser?key=' + self.apikey
         try:
-            return self.parse_result(requests.post(url, data=payload,
-                                     timeout=self.timeout))
+            return self.cache_token(self.parse_result(
+                self.session.post(url, data=payload, timeout=self.timeout)))
         except Exception as e:
             return False, 'ERROR: ' + str(e)
          
     def sign_in_with_email(self, email, password):
-        payload = json.dumps({'email': email, 'password': password,
-                              'returnSecureToken': 'true'})
+        payload = _dumps({'email': email, 'password': password,
+                          'returnSecureToken': 'true'})
         url = self.V3 + 'verifyPassword?key=' + self.apikey
         try:
-            return self.parse_result(requests.post(url, data=payload,
-                                     timeout=self.timeout))
+            return self.cache_token(self.parse_result(
+                self.session.post(url, data=payload, timeout=self.timeout)))
         except Exception as e:
             return False, 'ERROR: ' + str(e)
 
     def sign_in_with_token(self, refresh_token):
-        payload = json.dumps({'grantType': 'refresh_token',
-                              'refreshToken': refresh_token})
+        payload = _dumps({'grantType': 'refresh_token',
+                          'refreshToken': refresh_token})
         url = self.V1 + 'token?key=' + self.apikey
         try:
             success, response = self.parse_result(
-                requests.post(url,data=payload,timeout=self.timeout))
+                self.session.post(url,data=payload,timeout=self.timeout))
 
             if success:
                 # convert from v1 to v3
-                return True, {'localId': response['user_id'],
-                              'idToken': response['id_token'],
-                              'refreshToken': response['refresh_token']}
+                return self.cache_token((True, {
+                    'localId': response['user_id'],
+                    'idToken': response['id_token'],
+                    'refreshToken': response['refresh_token'],
+                    'expiresIn': response.get('expires_in', '3600')}))
             else:
                 return False, response
         except Exception as e:
@@ -67,19 +112,81 @@ class Authorize:
 
     def delete_user(self, response):
         if response and isinstance(response, dict) and 'idToken' in response:
-            payload = json.dumps({"idToken": response['idToken']})
+            payload = _dumps({"idToken": response['idToken']})
             url = self.V3 + 'deleteAccount?key=' + self.apikey
             try:
-                return self.parse_result(
-                    requests.post(url, data=payload,timeout=self.timeout))
+                success, result = self.parse_result(
+                    self.session.post(url, data=payload,timeout=self.timeout))
+                if success:
+                    self.clear_token(response)
+                return success, result
 
             except Exception as e:
                 return False, 'ERROR: ' + str(e)
         else:
             return False, 'ERROR: delete_user(), incorrect argument.' 
 
+    def get_id_token(self):
+        # The idToken of the latest sign in. If it expires within 60 seconds
+        # it is first refreshed with the saved refresh token. If the refresh
+        # fails the cached idToken is returned until it expires.
+        # Returns '' if there is no sign in, or no unexpired idToken;
+        # token_error then says why.
+        with self._token_lock:
+            now = monotonic()
+            if self._id_token and now < self._token_expiry - 60:
+                return self._id_token
+            if not self._refresh_token:
+                self.token_error = 'Not signed in.'
+                return ''
+            success, response = self.sign_in_with_token(self._refresh_token)
+            if success:
+                self.token_error = ''
+                return self._id_token
+            if response.startswith('ERROR: '):
+                response = response[len('ERROR: '):]
+            self.token_error = 'Token refresh failed, ' + response
+            if self._id_token and now < self._token_expiry:
+                return self._id_token
+            return ''
+
+    def cached_id_token(self):
+        # The idToken of the latest sign in if it does not expire within
+        # 60 seconds, else ''. Never blocks, returns '' while another
+        # thread is in get_id_token().
+        if not self._token_lock.acquire(blocking = False):
+            return ''
+        try:
+            if self._id_token and monotonic() < self._token_expiry - 60:
+                return self._id_token
+            return ''
+        finally:
+            self._token_lock.release()
+
+    def clear_token(self, response):
+        # Forget the cached sign in, if it is the user in response.
+        with self._token_lock:
+            if response.get('idToken') == self._id_token or\
+               response.get('localId', '') == self.local_id:
+                self.local_id = ''
+                self._id_token = ''
+                self._refresh_token = ''
+                self._token_expiry = 0
+
+    def cache_token(self, result):
+        success, response = result
+        if success and 'idToken' in response:
+            with self._token_lock:
+                self.local_id = response.get('localId', self.local_id)
+                self._id_token = response['idToken']
+                self._refresh_token = response.get('refreshToken',
+                                                   self._refresh_token)
+                self._token_expiry = monotonic() +\
+                    int(response.get('expiresIn', 3600))
+        return result
+
     def parse_result(self,r):
-        d = r.json()
+        d = _loads(r.content)
         if r.status_code == 200:
             return True, d
         elif 'error' in d and 'message' in d['error']:
@@ -87,77 +194,173 @@ class Authorize:
         else:
             return False, 'ERROR: ' + str(d)
 
-class Firestore:
+class _FirestoreBase:
+    # The Firestore API independent of how requests are made, see
+    # Firestore for blocking requests, and FirestoreAsync for coroutines.
+    MAX_SIZE = 19990
 
-    def __init__(self, project_id):
+    def __init__(self, project_id, http2 = True):
         endpoint = 'https://firestore.googleapis.com/v1/'
         self.path = 'projects/' + project_id + '/databases/(default)/documents/'
         self.REST = endpoint + self.path
+        self._commit_url = self.REST[:-1] + ':commit'
+        self._batch_url = self.REST[:-1] + ':batchWrite'
+        self._batch_get_url = self.REST[:-1] + ':batchGet'
+        self._query_url = self.REST[:-1] + ':runQuery'
         self.timeout = (6.01, 60)
+        self.session = self.open_session(http2)
+        self.max_update_attempts = 8
+        self.update_timeout_budget = 60
+        # Commits are rate limited per collection, and optionally
+        # the number of concurrent commits is limited to max_inflight.
+        self._buckets = defaultdict(lambda: _TokenBucket(capacity = 100,
+                                                         refill = 50))
+        self._buckets_lock = Lock()
+        self.max_inflight = 0
+        self._inflight = 0
+        # A condition per document being updated, see update().
+        self._doc_cvs = WeakValueDictionary()
+        self._doc_cvs_lock = Lock()
 
     def enable_database(self, auth):
+        # auth is a sign in response, or an Authorize instance which then
+        # supplies a current idToken for each request.
         self.local_id = ''
-        self.id_token = ''
-        if auth and isinstance(auth, dict) and\
+        id_token = ''
+        self.auth = None
+        if isinstance(auth, Authorize):
+            self.auth = auth
+            self.local_id = auth.local_id
+            # Refreshed if required by the first request.
+            id_token = auth.cached_id_token()
+        elif auth and isinstance(auth, dict) and\
            'localId' in auth and 'idToken' in auth:
             self.local_id = auth['localId']
-            self.id_token = auth['idToken']
+            id_token = auth['idToken']
+        self.refresh_token(id_token)
+
+    def refresh_token(self, id_token):
+        # Use a new idToken, for example from Authorize.sign_in_with_token().
+        # The headers are replaced in one assignment, so a concurrent
+        # request uses either the old or the new token.
+        self.id_token = id_token
+        headers = {'content-type' : 'application/json; charset=UTF-8',
+                   'Authorization' : 'Bearer ' + id_token}
+        gzip_headers = dict(headers)
+        gzip_headers['Content-Encoding'] = 'gzip'
+        self._headers = headers
+        self._gzip_headers = gzip_headers
 
     ########################
     # REST operations
     ########################
+    # Each operation is a generator of the I/O it needs, it yields an I/O
+    # tuple and is sent the result:
+    #   ('headers',) -> the request headers, with a current idToken
+    #   ('request', method, url, headers, params, data) -> response
+    #   ('write', url, headers, data, timeout) -> response, of a commit or
+    #       batchWrite, None if max_inflight writes are in progress for
+    #       timeout seconds (unbounded if None)
+    #   ('sleep', seconds) -> None
+    #   ('wait', condition, seconds) -> None, returns early if notified
+    #   ('notify', condition) -> None
+    # An exception raised by the I/O is thrown into the generator.
+    # Firestore and FirestoreAsync perform the I/O, see their run().
+    ########################
 
     # Create
     ########
-    def create(self, collection, document, data):
+    def _create(self, collection, document, data):
         if not collection:
             collection = self.local_id
         if not document:
             document = self.local_id
-        size = self.dict_size(data)
-        if size > 19990:
-            return  False, 'ERROR: ' +\
-                'Dict contains too many elements (' + str(size) +\
-                ') for Firestore.', ''
-        request_path = self.REST + collection + '?documentId=' + document
+        error = self.size_error(data)
+        if error:
+            return False, error, ''
+        request_path = f'{self.REST}{collection}?documentId={document}'
         try:
-            fs_data = {'fields' : self.dict_to_firestore(data, False)}
-            payload=json.dumps(fs_data).encode("utf-8")
-            r = requests.post(request_path, headers = self.build_headers(),
-                              data = payload,timeout=self.timeout)
-            return self.parse_result(r.json())
+            payload, headers = yield from\
+                self.compress(encode_payload({'fields' : _MapWrap(data)}))
+            r = yield ('request', 'POST', request_path, headers, None, payload)
+            return self.parse_result(_loads(r.content))
         except Exception as e:
             return False, 'ERROR: ' + str(e), ''
 
     # Read
     ########
-    def read(self, collection, document):
+    def _read(self, collection, document):
         if not collection:
             collection = self.local_id
         if not document:
             document = self.local_id
-        request_path = self.REST + collection + '/' + document
+        request_path = f'{self.REST}{collection}/{document}'
         try:
-            r = requests.get(request_path, headers=self.build_headers(),
-                             timeout=self.timeout)
-            return self.parse_result(r.json())
+            headers = yield ('headers',)
+            r = yield ('request', 'GET', request_path, headers, None, None)
+            return self.parse_result(_loads(r.content))
         except Exception as e:
             return False, 'ERROR: ' + str(e), ''
 
-    # Update
+    # Batch Get
     ########
-    # THIS METHOD MUST NOT BE CALLED FROM THE UI THREAD
+    # Read several documents from a collection with one request.
+    # Returns a list of (success, response, update_time), in the order of
+    # documents. A document that does not exist is an error.
+    ########
+    def _batch_get(self, collection, documents):
+        if not collection:
+            collection = self.local_id
+        names = [f'{self.path}{collection}/{document}'
+                 for document in documents]
+        try:
+            headers = yield ('headers',)
+            r = yield ('request', 'POST', self._batch_get_url, headers, None,
+                       _dumps({'documents': names}))
+            return self.batch_get_results(_loads(r.content), names)
+        except Exception as e:
+            return [(False, 'ERROR: ' + str(e), '')] * len(names)
+
+    # Query
+    ########
+    # structured_query is a Firestore StructuredQuery, for example:
+    # {'from': [{'collectionId': 'scores'}],
+    #  'where': {'fieldFilter': {'field': {'fieldPath': 'score'},
+    #                            'op': 'GREATER_THAN',
+    #                            'value': {'integerValue': '10'}}},
+    #  'limit': 20}
+    # The filtering is done by Firestore, the result is a list of
+    # (path, data, update_time) for each document, in query order.
+    # path is 'collection/document', relative to the database, so that
+    # documents of different collections (a collection group) are distinct.
+    # Reference:
+    # https://firebase.google.com/docs/firestore/reference/rest/v1/StructuredQuery
+    ########
+    def _query(self, structured_query):
+        try:
+            headers = yield ('headers',)
+            r = yield ('request', 'POST', self._query_url, headers, None,
+                       _dumps({'structuredQuery': structured_query}))
+            return self.query_results(_loads(r.content))
+        except Exception as e:
+            return False, 'ERROR: ' + str(e), ''
+
+    # Update
     ########
     # Firestore implementation constraint:
     # Read/write locking is only available for oAuth2 authorization.
     # So we read, then write using read update time as a precondition.
-    # Retry on fail. Afer 5 fast retries, use exponentially slower retry rate.
-    # Apparently this is what the Google mobile SDKs do.
+    # Retry on fail, after an exponential backoff with decorrelated jitter
+    # so that contending clients do not retry in lock step.
+    # The backoff is an upper bound, a successful update of the same
+    # document by this instance wakes the waiting updates to retry at once.
+    # Give up after max_update_attempts, or update_timeout_budget seconds,
+    # which includes any wait for the write rate limit.
     # Reference:
     # https://groups.google.com/g/google-cloud-firestore-discuss/c/4yJsxHsAK1s
+    # https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
     ########
-    def update(self, collection, document,
-               replace = {}, delete = {}, callback = None):
+    def _update(self, collection, document, replace, delete, callback):
         # replace: a dict of keys with new values to recursively assign.
         # delete: a dict of keys to recursively remove, leaf values ignored.
         #
@@ -170,129 +373,281 @@ class Firestore:
             collection = self.local_id
         if not document:
             document = self.local_id
-        backoff = 0
+        base = 0.05
+        cap = 30
+        backoff = base
         attempt = 0
+        start = monotonic()
+        cv = self.doc_condition(collection, document)
         while True:
-            # !!!!!sleep means this MUST be called in a non-UI thread
-            sleep(backoff) 
             attempt += 1
-            if attempt == 5:
-                backoff = 1
-            elif attempt > 5:
-                backoff *= 1.5
-            if backoff >= 60:
-                return False, 'ERROR: Update of ' + collection + '/' +\
-                    document + ' timed out.',''
-            
-            success, existing, update_time = self.read(collection, document)
+            success, existing, update_time =\
+                yield from self._read(collection, document)
             if success:
-                self.dict_replace(existing, replace)  
-                self.dict_pop(existing, delete)
-                if callback:
-                    callback(existing)
-                size = self.dict_size(existing)
-                if size > 19990:
-                    return  False, 'ERROR: ' +\
-                        'Dict contains too many elements (' + str(size) +\
-                        ') for Firestore.', ''
-                request_path = self.REST[:-1] + ':commit' 
+                self.dict_modify(existing, replace, delete, callback)
+                error = self.size_error(existing)
+                if error:
+                    return False, error, ''
                 try:
-                    fs_data = {}
-                    fs_data['fields'] = self.dict_to_firestore(existing, False)
-                    fs_data['name'] = self.path + collection + '/' + document
-                    commit = {'writes':
-                              [{'update': fs_data,
-                                'currentDocument': {'updateTime': update_time}
-                                }]}
-                    payload=json.dumps(commit).encode("utf-8")
-                    r = requests.post(request_path,
-                                      headers=self.build_headers(),
-                                      data = payload,
-                                      timeout=self.timeout)
-                    t = r.json()
-                    if r.status_code == 400 and\
+                    payload = self.update_payload(collection, document,
+                                                  existing, update_time)
+                    budget = self.update_timeout_budget -\
+                        (monotonic() - start)
+                    status_code, t =\
+                        yield from self._post_write([collection],
+                                                    self._commit_url,
+                                                    payload, budget)
+                    if status_code is None:
+                        return self.update_timed_out(collection, document)
+                    if status_code == 400 and\
                        'error' in t and 'status' in t['error']:
                         if t['error']['status'] == 'FAILED_PRECONDITION':
+                            backoff = min(cap, uniform(base, backoff * 3))
+                            if attempt >= self.max_update_attempts or\
+                               monotonic() - start + backoff >\
+                               self.update_timeout_budget:
+                                return self.update_timed_out(collection,
+                                                             document)
+                            yield ('wait', cv, backoff)
                             continue
+                    if status_code == 200:
+                        yield ('notify', cv)
                     # Commit does not return what was written.
                     # We could read again, but we know that is not reliable.
-                    # So we return what we wanted to write: this is a read, 
+                    # So we return what we wanted to write: this is a read,
                     # modified and sanity checked.
-                    return self.parse_result_update(t, existing) 
+                    return self.parse_result_update(t, existing)
                 except Exception as e:
                     return False, 'ERROR: ' + str(e), ''
             else:
                 return False, existing, update_time
 
+    def update_timed_out(self, collection, document):
+        return False, 'ERROR: Update of ' + collection + '/' + document +\
+            ' timed out.', ''
+
+    def doc_condition(self, collection, document):
+        # The condition shared by the updates of a document. It exists while
+        # an update of the document holds a reference.
+        with self._doc_cvs_lock:
+            cv = self._doc_cvs.get((collection, document))
+            if cv is None:
+                cv = self.new_condition()
+                self._doc_cvs[(collection, document)] = cv
+            return cv
+
+    def dict_modify(self, existing, replace, delete, callback):
+        self.dict_replace(existing, replace)
+        self.dict_pop(existing, delete)
+        if callback:
+            callback(existing)
+
+    def update_payload(self, collection, document, existing, update_time):
+        fs_data = {}
+        fs_data['fields'] = _MapWrap(existing)
+        fs_data['name'] = f'{self.path}{collection}/{document}'
+        commit = {'writes':
+                  [{'update': fs_data,
+                    'currentDocument': {'updateTime': update_time}
+                    }]}
+        return encode_payload(commit)
+
+    # Patch
+    ########
+    # Replace top level keys without reading the document first.
+    # Only the keys in replace are written, other keys are unchanged.
+    # There is no merge below the top level, and no precondition unless
+    # update_time is given, so concurrent writes to the same key are
+    # last writer wins. Use update() for hierarchical or conditional changes.
+    # The document is created if it does not exist.
+    ########
+    def _patch(self, collection, document, replace, update_time):
+        if not collection:
+            collection = self.local_id
+        if not document:
+            document = self.local_id
+        if not replace:
+            # Without an updateMask a PATCH replaces the whole document.
+            return False, 'ERROR: patch() requires at least one key.', ''
+        error = self.size_error(replace)
+        if error:
+            return False, error, ''
+        request_path = f'{self.REST}{collection}/{document}'
+        params = self.patch_params(replace, update_time)
+        try:
+            payload, headers = yield from\
+                self.compress(encode_payload({'fields' : _MapWrap(replace)}))
+            r = yield ('request', 'PATCH', request_path, headers, params,
+                       payload)
+            return self.parse_result(_loads(r.content))
+        except Exception as e:
+            return False, 'ERROR: ' + str(e), ''
+
+    def patch_params(self, replace, update_time):
+        assert replace, 'ERROR: A patch must have an updateMask.'
+        params = [('updateMask.fieldPaths', self.field_path(key))
+                  for key in replace]
+        if update_time:
+            params.append(('currentDocument.updateTime', update_time))
+        return params
+
     # Delete
     ########
-    def delete(self, collection, document):
+    def _delete(self, collection, document):
         if not collection:
             collection = self.local_id
         if not document:
             document = self.local_id
-        request_path = self.REST + collection + '/' + document
+        request_path = f'{self.REST}{collection}/{document}'
         try:
-            r = requests.delete(request_path, headers=self.build_headers(),
-                                timeout=self.timeout)
+            headers = yield ('headers',)
+            r = yield ('request', 'DELETE', request_path, headers, None, None)
             if r.status_code == 200:
                 return True, {}, ''
             else:
-                return self.parse_result(r.json())
+                return self.parse_result(_loads(r.content))
         except Exception as e:
             return False, 'ERROR: ' + str(e), ''
 
+    # Batch Write
+    ########
+    # ops is a list of (operation, collection, document, data, update_time)
+    # tuples, where operation is 'create', 'update', or 'delete'.
+    # An update writes data as the complete document, a delete ignores data.
+    # A non-empty update_time is a precondition on the existing document.
+    #
+    # Writes are sent up to 500 per request. If atomic is False each write
+    # succeeds or fails independently, if True each group of 500 writes
+    # is committed or rejected together.
+    #
+    # Returns a list of (success, response, update_time), in the order of ops.
+    ########
+    def _batch_write(self, ops, atomic):
+        if atomic:
+            request_path = self._commit_url
+        else:
+            request_path = self._batch_url
+        results = []
+        ops = iter(ops)
+        chunk = list(islice(ops, 500))
+        while chunk:
+            results.extend((yield from self._batch_chunk(request_path, chunk,
+                                                         atomic)))
+            chunk = list(islice(ops, 500))
+        return results
+
+    def _batch_chunk(self, request_path, chunk, atomic):
+        results, indices, writes, collections = self.batch_writes(chunk)
+        if atomic and len(writes) < len(chunk):
+            return self.batch_failed(results, indices,
+                                     'ERROR: Commit not sent, ' +\
+                                     'a write in the commit is invalid.')
+        if not writes:
+            return results
+        try:
+            payload = b'{"writes":[' + b','.join(writes) + b']}'
+            status_code, t = yield from self._post_write(collections,
+                                                         request_path,
+                                                         payload)
+        except Exception as e:
+            return self.batch_failed(results, indices, 'ERROR: ' + str(e))
+        return self.batch_results(t, results, indices)
+
+    def batch_writes(self, chunk):
+        # The JSON encoded writes for a chunk of ops, with a result per op.
+        # Each write is encoded separately, so the result of an invalid op
+        # is an error and the other ops are unaffected. indices locate the
+        # results of the valid ops.
+        results = []
+        writes = []
+        indices = []
+        collections = set()
+        for op in chunk:
+            if not isinstance(op, (tuple, list)) or len(op) != 5:
+                results.append((False, 'ERROR: Batch operation ' +\
+                                str(op) + ' is not (operation, collection,' +\
+                                ' document, data, update_time).', ''))
+                continue
+            operation, collection, document, data, update_time = op
+            if not collection:
+                collection = self.local_id
+            if not document:
+                document = self.local_id
+            name = f'{self.path}{collection}/{document}'
+            if operation == 'delete':
+                data = {}
+                write = {'delete': name}
+            elif operation in ['create', 'update']:
+                if not isinstance(data, dict):
+                    results.append((False, 'ERROR: Batch ' + operation +\
+                                    ' data must be a dict.', ''))
+                    continue
+                error = self.size_error(data)
+                if error:
+                    results.append((False, error, ''))
+                    continue
+                write = {'update': {'name': name,
+                                    'fields': _MapWrap(data)}}
+            else:
+                results.append((False, 'ERROR: Batch operation ' +\
+                                str(operation) + ' is not available.', ''))
+                continue
+            if update_time:
+                write['currentDocument'] = {'updateTime': update_time}
+            elif operation == 'create':
+                write['currentDocument'] = {'exists': False}
+            try:
+                write = encode_payload(write)
+            except Exception as e:
+                results.append((False, 'ERROR: ' + str(e), ''))
+                continue
+            collections.add(collection)
+            indices.append(len(results))
+            writes.append(write)
+            results.append((True, data, ''))
+        return results, indices, writes, collections
+
+    def batch_results(self, t, results, indices):
+        if 'writeResults' not in t:
+            if 'error' in t and 'message' in t['error']:
+                return self.batch_failed(results, indices,
+                                         'ERROR: ' + t['error']['message'])
+            return self.batch_failed(results, indices, 'ERROR:' + str(t))
+        # batchWrite reports a status per write, commit is all or nothing.
+        status = t.get('status', [])
+        for i, index in enumerate(indices):
+            if i < len(status) and status[i].get('code', 0):
+                results[index] = (False, 'ERROR: ' +\
+                                  status[i].get('message', str(status[i])),'')
+            else:
+                write_result = t['writeResults'][i]
+                update_time = write_result.get('updateTime',
+                                               t.get('commitTime', ''))
+                results[index] = (True, results[index][1], update_time)
+        return results
+
+    def batch_failed(self, results, indices, message):
+        for index in indices:
+            results[index] = (False, message, '')
+        return results
+
     ###################
     # Dict translation
     ###################
 
     def dict_to_firestore(self, data, parent_is_list):
-    
+        # The write path does not build this intermediate dict, it uses
+        # encode_payload(). Kept for callers that want the typed dict.
+
+        def fields(value):
+            return self.dict_to_firestore(value, False)
+
+        def values(value):
+            return self.dict_to_firestore(value, True)
+
         def map(ref, value):
-            if value == None:
-                return {'nullValue' : None} 
-            elif isinstance(value, bool):
-                return {'booleanValue' : value}
-            elif isinstance(value, int):
-                return {'integerValue' : str(value)}
-            elif isinstance(value, float):
-                return {'doubleValue' : value} 
-            elif isinstance(value, str):
-                return {'stringValue' : value}
-            elif isinstance(value, bytes):
-                return {'bytesValue' : value.decode('utf-8')} 
-            elif isinstance(value, GeoPoint):
-                return {'geoPointValue': value.get() }
-            elif isinstance(value, TimeStamp):
-                return {'timestampValue' : value.get() } 
-            elif isinstance(value, Reference):
-                return {'referenceValue' : value.get() } 
-            elif isinstance(value, list):
-                if parent_is_list:
-                    assert False,\
-                        'ERROR: Nested lists are not available in Firestore.' 
-                    return {'nullValue' : None}
-                return {'arrayValue' :
-                        {'values' : self.dict_to_firestore(value, True)}}
-            elif isinstance(value, dict):
-                return {'mapValue' :
-                        {'fields' : self.dict_to_firestore(value, False)}}
-            elif isinstance(value, bytearray) or\
-                 isinstance(value, memoryview) or\
-                 isinstance(value, tuple) or\
-                 isinstance(value, complex) or\
-                 isinstance(value, range) or\
-                 isinstance(value, frozenset) or\
-                 isinstance(value, set):
-                assert False, 'ERROR: ' + ref + 'value type ' +\
-                    str(type(value)) + ' is not available in Firestore.' 
-                return {'nullValue' : None}
-            else:
-                assert False,\
-                    'ERROR: Class ' + str(type(value)) +\
-                    ' is not available in Firestore.'
-                return {'nullValue' : None} 
-        
+            return fs_value(ref, value, parent_is_list, fields, values)
+
         if isinstance(data, dict):
             '''
             if len(data.keys()) > 20:
@@ -338,40 +693,44 @@ class Firestore:
                 return True
             return False
             
-        new_dict = {}
-        if isinstance(data, dict):
-            for key in data:
-                value = data[key]
+        # Iterative, a work item is a Firestore value, or dict of values,
+        # and the location (parent[slot]) of its translation.
+        result = [None]
+        work = deque([(data, result, 0)])
+        while work:
+            data, parent, slot = work.popleft()
+            if not isinstance(data, dict):
+                parent[slot] = {}
+                continue
+            for key, value in data.items():
                 if is_scalar_value(value):
-                    if key in ['nullValue']:
-                        return None
-                    elif key in ['stringValue']:
-                        return str(value)
-                    elif key in ['booleanValue']: 
-                        return bool(value)
-                    elif key in ['integerValue']:
-                        return int(value)
-                    elif key in ['doubleValue']:
-                        return float(value)
-                    elif key in ['bytesValue']:
-                        return bytes(value.encode(errors='ignore'))
-                    elif key in ['timestampValue']:   
-                        return TimeStamp(str(value))
-                    elif key in ['referenceValue']:
-                        return Reference(str(value))
-                elif key in ['mapValue'] and is_dict_value(value, ['fields']):
-                    return self.dict_from_firestore(value['fields'])
-                elif key in ['arrayValue'] and is_dict_value(value, ['values']):
-                    array = []
-                    for v in value['values']:
-                        array.append(self.dict_from_firestore(v))
-                    return array
-                elif key in ['geoPointValue'] and\
+                    decoder = _FS_DECODERS.get(key)
+                    if decoder:
+                        parent[slot] = decoder(value)
+                        break
+                elif key == 'mapValue' and is_dict_value(value, ['fields']):
+                    work.append((value['fields'], parent, slot))
+                    break
+                elif key == 'arrayValue' and is_dict_value(value, ['values']):
+                    array = [None] * len(value['values'])
+                    parent[slot] = array
+                    for i, v in enumerate(value['values']):
+                        work.append((v, array, i))
+                    break
+                elif key == 'geoPointValue' and\
                      is_dict_value(value, ['latitude', 'longitude']):
-                    return GeoPoint(value['latitude'], value['longitude'])
-                else:
-                    new_dict[key] = self.dict_from_firestore(value)
-        return new_dict
+                    parent[slot] = GeoPoint(value['latitude'],
+                                            value['longitude'])
+                    break
+            else:
+                # Not a value, a dict of values.
+                new_dict = {}
+                parent[slot] = new_dict
+                for key, value in data.items():
+                    if not is_scalar_value(value):
+                        new_dict[key] = None  # keeps the key order
+                        work.append((value, new_dict, key))
+        return result[0]
 
     ###############
     # Dict update
@@ -416,15 +775,23 @@ class Firestore:
             for ele in removes:   
                 if not isinstance(ele, tuple):
                     return []
-            descending = sorted(removes, key = lambda x: x[0], reverse = True)
-            for ele in descending:  
-                index = ele[0]
-                value = ele[1]
+            # Recurse using the original indices, then drop elements in
+            # one pass. A negative index counts from the end of the
+            # original list, out of range indices are ignored.
+            drop = set()
+            for index, value in removes:
+                if -len(existing) <= index < 0:
+                    index += len(existing)
+                if not 0 <= index < len(existing):
+                    continue
                 if value and\
                    (isinstance(value, dict) or isinstance(value, list)):
                     self.dict_pop(existing[index], value)
-                elif index < len(existing):
-                    existing.pop(index)
+                else:
+                    drop.add(index)
+            if drop:
+                existing[:] = [x for i, x in enumerate(existing)
+                               if i not in drop]
         return existing
 
     ###############
@@ -432,22 +799,158 @@ class Firestore:
     ###############
 
     def build_headers(self):
+        if self.auth:
+            return self.auth_headers(self.auth.get_id_token())
         assert self.id_token, 'Database not enabled.'
-        return {'content-type' : 'application/json; charset=UTF-8',
-                'Authorization' : 'Bearer ' + self.id_token}
+        return self._headers
+
+    def auth_headers(self, id_token):
+        # The headers for an idToken from self.auth.
+        assert id_token, self.auth.token_error or 'Database not enabled.'
+        if id_token != self.id_token:
+            self.refresh_token(id_token)
+        return self._headers
+
+    def field_path(self, key):
+        # Keys that are not simple identifiers must be quoted in a field path.
+        key = str(key)
+        if fullmatch('[a-zA-Z_][a-zA-Z_0-9]*', key):
+            return key
+        return '`' + key.replace('\\', '\\\\').replace('`', '\\`') + '`'
 
-    def dict_size(self, data):
+    def dict_size(self, data, cap = None):
+        # The number of leaf values in data.
+        # Iterative, and stops counting as soon as the count exceeds cap.
         count = 0
-        if isinstance(data, dict):
-            for key in data.keys():
-                count += self.dict_size(data[key])
-        elif isinstance(data, list):
-            for ele in data:
-                count += self.dict_size(ele)
-        else:
-            count += 1
+        stack = [data]
+        while stack:
+            value = stack.pop()
+            if isinstance(value, dict):
+                stack.extend(value.values())
+            elif isinstance(value, list):
+                stack.extend(value)
+            else:
+                count += 1
+                if cap is not None and count > cap:
+                    return count
         return count
+
+    def size_error(self, data):
+        if self.dict_size(data, self.MAX_SIZE) > self.MAX_SIZE:
+            return 'ERROR: Dict contains more than ' + str(self.MAX_SIZE) +\
+                ' elements, too many for Firestore.'
+        return ''
     
+    def compress(self, payload):
+        # Returns the payload, gzipped if over 1kB, and the headers to send
+        # it with. Level 1 is fast, and compresses JSON well.
+        # Responses are compressed by default, requests and httpx both send
+        # Accept-Encoding: gzip.
+        headers = yield ('headers',)
+        if len(payload) > 1024:
+            return gzip.compress(payload, compresslevel = 1),\
+                self._gzip_headers
+        return payload, headers
+
+    def _post_write(self, collections, request_path, payload, budget = None):
+        # POST a commit or batchWrite, returns the status code and response.
+        # Waits for a token from the bucket of each collection written,
+        # and for fewer than max_inflight (if not 0) writes in progress.
+        # A bucket's refill rate halves when Firestore reports contention
+        # or overload, and grows by one token per second on each success.
+        # If budget is not None and these waits would take longer than
+        # budget seconds, the write is not sent and returns None, None.
+        start = monotonic()
+        buckets = self.write_buckets(collections)
+        for bucket in buckets:
+            if budget is None:
+                delay = bucket.take()
+            else:
+                delay = bucket.take(budget - (monotonic() - start))
+                if delay is None:
+                    return None, None
+            if delay:
+                yield ('sleep', delay)
+        timeout = None
+        if budget is not None:
+            timeout = max(0, budget - (monotonic() - start))
+        payload, headers = yield from self.compress(payload)
+        r = yield ('write', request_path, headers, payload, timeout)
+        if r is None:
+            return None, None
+        return self.write_feedback(buckets, r)
+
+    def inflight_available(self):
+        return not self.max_inflight or self._inflight < self.max_inflight
+
+    def write_buckets(self, collections):
+        with self._buckets_lock:
+            return [self._buckets[c] for c in collections]
+
+    def write_feedback(self, buckets, r):
+        # Adjust the rate limits from the response, and parse it.
+        throttled = r.status_code in [429, 503]
+        if throttled:
+            for bucket in buckets:
+                bucket.on_throttle()
+        t = _loads(r.content)
+        if not throttled:
+            if r.status_code == 400 and 'error' in t and\
+               t['error'].get('status') == 'FAILED_PRECONDITION':
+                for bucket in buckets:
+                    bucket.on_throttle()
+            elif r.status_code == 200:
+                for bucket in buckets:
+                    bucket.on_success()
+        return r.status_code, t
+
+    def batch_get_results(self, t, names):
+        # t is a list of results in any order, each has 'found' or 'missing'.
+        results = {}
+        error = ''
+        if isinstance(t, dict):
+            error = self.error_message(t)
+        else:
+            for entry in t:
+                if 'found' in entry:
+                    found = entry['found']
+                    data = self.dict_from_firestore(found.get('fields', {}))
+                    results[found['name']] =\
+                        (True, data, found.get('updateTime', ''))
+                elif 'missing' in entry:
+                    results[entry['missing']] =\
+                        (False, 'ERROR: ' + entry['missing'] + ' not found.',
+                         '')
+                elif 'error' in entry:
+                    error = self.error_message(entry)
+        if not error:
+            error = 'ERROR: No result.'
+        return [results.get(name, (False, error, '')) for name in names]
+
+    def query_results(self, t):
+        # t is a list of results, those with a 'document' are the matches.
+        if isinstance(t, dict):
+            return False, self.error_message(t), ''
+        documents = []
+        for entry in t:
+            if 'error' in entry:
+                return False, self.error_message(entry), ''
+            if 'document' in entry:
+                document = entry['document']
+                path = document['name']
+                if path.startswith(self.path):
+                    path = path[len(self.path):]
+                documents.append(
+                    (path,
+                     self.dict_from_firestore(document.get('fields', {})),
+                     document.get('updateTime', '')))
+        return True, documents, ''
+
+    def error_message(self, r):
+        if 'error' in r and 'message' in r['error']:
+            return 'ERROR: ' + r['error']['message']
+        return 'ERROR:' + str(r)
+
     def parse_result(self,r):
         if 'fields' in r:
             data = self.dict_from_firestore(r['fields'])
@@ -471,6 +974,392 @@ class Firestore:
             return False, 'ERROR:' + str(r), ''
         
     
+class Firestore(_FirestoreBase):
+    # The Firestore API, each method returns when its requests complete.
+
+    def __init__(self, project_id, http2 = True):
+        super().__init__(project_id, http2)
+        self._executor = None
+        self._executor_lock = Lock()
+        self._inflight_cv = Condition()
+
+    def open_session(self, http2):
+        return new_session(http2, self.timeout)
+
+    def close(self):
+        # Release the connection pool, and the parallel() worker threads.
+        with self._executor_lock:
+            executor = self._executor
+            self._executor = None
+        if executor:
+            executor.shutdown()
+        self.session.close()
+
+    def new_condition(self):
+        return Condition()
+
+    ########################
+    # REST operations, see _FirestoreBase
+    ########################
+
+    def create(self, collection, document, data):
+        return self.run(self._create(collection, document, data))
+
+    def read(self, collection, document):
+        return self.run(self._read(collection, document))
+
+    def batch_get(self, collection, documents):
+        return self.run(self._batch_get(collection, documents))
+
+    def query(self, structured_query):
+        return self.run(self._query(structured_query))
+
+    # THIS METHOD MUST NOT BE CALLED FROM THE UI THREAD
+    def update(self, collection, document,
+               replace = {}, delete = {}, callback = None):
+        return self.run(self._update(collection, document,
+                                     replace, delete, callback))
+
+    def patch(self, collection, document, replace, update_time = ''):
+        return self.run(self._patch(collection, document,
+                                    replace, update_time))
+
+    def delete(self, collection, document):
+        return self.run(self._delete(collection, document))
+
+    def batch_write(self, ops, atomic = False):
+        return self.run(self._batch_write(ops, atomic))
+
+    # Parallel
+    ########
+    # ops is a list of tuples, each an operation name followed by the
+    # arguments of that method, for example:
+    # [('read', 'collection', 'document'),
+    #  ('create', 'collection', 'document', data),
+    #  ('delete', 'collection', 'document')]
+    #
+    # The operations are independent, and are performed concurrently by a
+    # pool of worker threads sharing the connection pool.
+    # The default of 20 workers is deliberate, more gives no further gain.
+    # The pool is created on first use, max_workers is ignored after that.
+    #
+    # Returns a list of (success, response, update_time), in the order of ops.
+    ########
+    def parallel(self, ops, max_workers = 20):
+        with self._executor_lock:
+            if not self._executor:
+                self._executor = ThreadPoolExecutor(max_workers = max_workers)
+            executor = self._executor
+        results = [None] * len(ops)
+        futures = {}
+        for index, op in enumerate(ops):
+            if op and op[0] in ['create', 'read', 'update', 'delete']:
+                method = getattr(self, op[0])
+                futures[executor.submit(method, *op[1:])] = index
+            else:
+                results[index] = (False, 'ERROR: Parallel operation ' +\
+                                  str(op[0] if op else op) +\
+                                  ' is not available.', '')
+        for future in as_completed(futures):
+            try:
+                results[futures[future]] = future.result()
+            except Exception as e:
+                results[futures[future]] = (False, 'ERROR: ' + str(e), '')
+        return results
+
+    ########################
+    # I/O
+    ########################
+
+    def run(self, steps):
+        # Perform the I/O of an operation, returns its result.
+        try:
+            io = next(steps)
+            while True:
+                try:
+                    result = getattr(self, 'io_' + io[0])(*io[1:])
+                except Exception as e:
+                    io = steps.throw(e)
+                else:
+                    io = steps.send(result)
+        except StopIteration as e:
+            return e.value
+
+    def io_headers(self):
+        return self.build_headers()
+
+    def io_request(self, method, url, headers, params, data):
+        return self.session.request(method, url, headers = headers,
+                                    params = params, data = data,
+                                    timeout = self.timeout)
+
+    def io_write(self, url, headers, data, timeout):
+        # Wait for fewer than max_inflight (if not 0) writes in progress.
+        with self._inflight_cv:
+            if not self._inflight_cv.wait_for(self.inflight_available,
+                                              timeout):
+                return None
+            self._inflight += 1
+        try:
+            return self.session.post(url, headers = headers, data = data,
+                                     timeout = self.timeout)
+        finally:
+            with self._inflight_cv:
+                self._inflight -= 1
+                self._inflight_cv.notify()
+
+    def io_sleep(self, seconds):
+        sleep(seconds)
+
+    def io_wait(self, cv, timeout):
+        # !!!!!wait means this MUST be called in a non-UI thread
+        with cv:
+            cv.wait(timeout = timeout)
+
+    def io_notify(self, cv):
+        with cv:
+            cv.notify_all()
+
+
+class FirestoreAsync(_FirestoreBase):
+    # The Firestore API with coroutines, for use with asyncio.
+    # Requires httpx. Requests are multiplexed over one HTTP/2 connection,
+    # and waits are asyncio.sleep() so the event loop is never blocked.
+    # Each of create, read, batch_get, query, update, patch, delete,
+    # batch_write, and parallel is a coroutine with the same arguments and
+    # results as the Firestore method. parallel() ignores max_workers.
+
+    def __init__(self, project_id):
+        assert httpx, 'FirestoreAsync requires httpx[http2].'
+        super().__init__(project_id)
+        # Created in the event loop, on first use.
+        self._inflight_cv = None
+
+    def open_session(self, http2):
+        return _Http2Session(self.timeout, httpx.AsyncClient)
+
+    async def close(self):
+        await self.session.aclose()
+
+    def new_condition(self):
+        return asyncio.Condition()
+
+    ########################
+    # REST operations, see _FirestoreBase
+    ########################
+
+    async def create(self, collection, document, data):
+        return await self.run(self._create(collection, document, data))
+
+    async def read(self, collection, document):
+        return await self.run(self._read(collection, document))
+
+    async def batch_get(self, collection, documents):
+        return await self.run(self._batch_get(collection, documents))
+
+    async def query(self, structured_query):
+        return await self.run(self._query(structured_query))
+
+    async def update(self, collection, document,
+                     replace = {}, delete = {}, callback = None):
+        return await self.run(self._update(collection, document,
+                                           replace, delete, callback))
+
+    async def patch(self, collection, document, replace, update_time = ''):
+        return await self.run(self._patch(collection, document,
+                                          replace, update_time))
+
+    async def delete(self, collection, document):
+        return await self.run(self._delete(collection, document))
+
+    async def batch_write(self, ops, atomic = False):
+        return await self.run(self._batch_write(ops, atomic))
+
+    # Batch, Parallel
+    ########
+    # ops is a list of tuples, each an operation name followed by the
+    # arguments of that method, as for Firestore.parallel().
+    # The operations are performed concurrently.
+    # Returns a list of (success, response, update_time), in the order of ops.
+    ########
+    async def batch(self, ops):
+        results = await asyncio.gather(*(self.batch_op(op) for op in ops),
+                                       return_exceptions = True)
+        return [(False, 'ERROR: ' + str(r), '')
+                if isinstance(r, Exception) else r for r in results]
+
+    async def parallel(self, ops, max_workers = None):
+        return await self.batch(ops)
+
+    async def batch_op(self, op):
+        if op and op[0] in ['create', 'read', 'update', 'delete']:
+            return await getattr(self, op[0])(*op[1:])
+        return (False, 'ERROR: Parallel operation ' +\
+                str(op[0] if op else op) + ' is not available.', '')
+
+    ########################
+    # I/O
+    ########################
+
+    async def run(self, steps):
+        # Perform the I/O of an operation, returns its result.
+        try:
+            io = next(steps)
+            while True:
+                try:
+                    result = await getattr(self, 'io_' + io[0])(*io[1:])
+                except Exception as e:
+                    io = steps.throw(e)
+                else:
+                    io = steps.send(result)
+        except StopIteration as e:
+            return e.value
+
+    async def io_headers(self):
+        # Refreshing the idToken is a blocking request, so it is made in
+        # a worker thread rather than in the event loop.
+        if self.auth:
+            id_token = self.auth.cached_id_token()
+            if not id_token:
+                loop = asyncio.get_event_loop()
+                id_token = await loop.run_in_executor(None,
+                                                      self.auth.get_id_token)
+            return self.auth_headers(id_token)
+        return self.build_headers()
+
+    async def io_request(self, method, url, headers, params, data):
+        return await self.session.request(method, url, headers = headers,
+                                          params = params, data = data)
+
+    async def io_write(self, url, headers, data, timeout):
+        # Wait for fewer than max_inflight (if not 0) writes in progress.
+        if not self._inflight_cv:
+            self._inflight_cv = asyncio.Condition()
+        async with self._inflight_cv:
+            if not self.inflight_available():
+                try:
+                    await asyncio.wait_for(
+                        self._inflight_cv.wait_for(self.inflight_available),
+                        timeout)
+                except asyncio.TimeoutError:
+                    return None
+            self._inflight += 1
+        try:
+            return await self.session.post(url, headers = headers,
+                                           data = data)
+        finally:
+            async with self._inflight_cv:
+                self._inflight -= 1
+                self._inflight_cv.notify()
+
+    async def io_sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+    async def io_wait(self, cv, timeout):
+        async with cv:
+            try:
+                await asyncio.wait_for(cv.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def io_notify(self, cv):
+        async with cv:
+            cv.notify_all()
+
+##########################################
+# HTTP connection pool
+##########################################
+
+def new_session(http2 = False, timeout = None):
+    # One keep-alive connection pool per instance, so that consecutive
+    # requests reuse a socket rather than repeat the DNS/TCP/TLS handshake.
+    # With HTTP/2 concurrent requests share one connection.
+    if http2 and httpx:
+        return _Http2Session(timeout, httpx.Client)
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_connections=32,
+                                          pool_maxsize=32,
+                                          max_retries=0))
+    return session
+
+class _Http2Session:
+    # The part of the requests.Session interface used here, implemented
+    # with an httpx.Client or httpx.AsyncClient, with an AsyncClient the
+    # methods return awaitables. timeout is (connect, read) and applies to
+    # every request, the per request timeout argument is ignored.
+    def __init__(self, timeout, client_class):
+        connect, read = timeout
+        self.client = client_class(
+            http2 = True,
+            timeout = httpx.Timeout(read, connect = connect),
+            limits = httpx.Limits(max_connections = 32,
+                                  max_keepalive_connections = 32))
+        self.headers = self.client.headers
+
+    def request(self, method, url, headers = None, params = None,
+                data = None, timeout = None):
+        return self.client.request(method, url, headers = headers,
+                                   params = params, content = data)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        self.client.close()
+
+    def aclose(self):
+        return self.client.aclose()
+
+##########################################
+# Write rate limiter
+##########################################
+
+class _TokenBucket:
+    # A token bucket whose refill rate (tokens per second) adapts:
+    # halved on throttle, additive increase on success, up to its
+    # initial value.
+    def __init__(self, capacity, refill):
+        self.capacity = capacity
+        self.max_refill = refill
+        self.refill = refill
+        self.tokens = capacity
+        self.last = monotonic()
+        self.lock = Lock()
+
+    def take(self, max_wait = None):
+        # Take a token, returns the seconds to wait before using it.
+        # If that is longer than max_wait no token is taken, returns None.
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.last) * self.refill)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            delay = (1 - self.tokens) / self.refill
+            if max_wait is not None and delay > max_wait:
+                return None
+            self.tokens -= 1
+            return delay
+
+    def on_throttle(self):
+        with self.lock:
+            self.refill = max(1, self.refill / 2)
+
+    def on_success(self):
+        with self.lock:
+            self.refill = min(self.max_refill, self.refill + 1)
+
 ##########################################
 # Classes for Firestore custom data types
 ##########################################
@@ -481,6 +1370,8 @@ class GeoPoint:
     # Conversion conventions:
     # Out of range values will be truncated to the poles or the antimeridian.
     # Every argument type except int and float default to equator or meridian.
+    __slots__ = ('dict',)
+
     def __init__(self, latitude, longitude):
         if not isinstance(latitude, int) and not isinstance(latitude, float):
             latitude = 0
@@ -494,6 +1385,8 @@ class GeoPoint:
         
 class TimeStamp:
     # value is a ISO 8601 string
+    __slots__ = ('datetime',)
+
     def __init__(self, value):
         self.datetime = "2000-01-01T00:00:00Z" # default last millenium
         if isinstance(value, str):
@@ -507,9 +1400,150 @@ class Reference:
     # The value is a string specifing an existind document.
     # Format of the value is:
     # 'projects/{project}/databases/(default)/documents/{collection}/{document}
+    __slots__ = ('document',)
+
     def __init__(self, value):
         self.document = value
 
     def get(self):
         return self.document
 
+
+##########################################
+# Firestore value encoders by Python type, and decoders by Firestore key
+##########################################
+
+def _integer_value(v):
+    return {'integerValue' : str(int(v))}
+
+# Values are converted to the base type, so that subclasses (for example
+# numpy.float64) are encoded by orjson, which only accepts the base types.
+_FS_ENCODERS = {
+    type(None): lambda v: {'nullValue' : None},
+    bool:       lambda v: {'booleanValue' : bool(v)},
+    int:        _integer_value,
+    float:      lambda v: {'doubleValue' : float(v)},
+    str:        lambda v: {'stringValue' : str.__str__(v)},
+    bytes:      lambda v: {'bytesValue' : v.decode('utf-8')},
+    GeoPoint:   lambda v: {'geoPointValue' : v.dict},
+    TimeStamp:  lambda v: {'timestampValue' : v.datetime},
+    Reference:  lambda v: {'referenceValue' : v.document},
+}
+
+# Shared translations of small integers, for the streaming encoder only.
+# It JSON encodes each translation at once, so they are never mutated.
+_SMALL_INT_VALUES = {i: {'integerValue' : str(i)} for i in range(-256, 1025)}
+
+def _shared_integer_value(v):
+    cached = _SMALL_INT_VALUES.get(v)
+    if cached is not None:
+        return cached
+    return _integer_value(v)
+
+_FS_STREAM_ENCODERS = dict(_FS_ENCODERS)
+_FS_STREAM_ENCODERS[int] = _shared_integer_value
+
+_FS_DECODERS = {
+    'nullValue':      lambda v: None,
+    'stringValue':    str,
+    'booleanValue':   bool,
+    'integerValue':   int,
+    'doubleValue':    float,
+    'bytesValue':     lambda v: v.encode(errors='ignore'),
+    'timestampValue': lambda v: TimeStamp(str(v)),
+    'referenceValue': lambda v: Reference(str(v)),
+}
+
+##########################################
+# Firestore value translation
+##########################################
+
+# Python types that have no Firestore equivalent.
+_BANNED_TYPES = (bytearray, memoryview, tuple, complex, range, frozenset, set)
+
+def fs_value(ref, value, parent_is_list, fields, values,
+             encoders = _FS_ENCODERS):
+    # Firestore typed value of a Python value. A dict or list is passed to
+    # fields() or values(), which either translate it now or defer it.
+    encoder = encoders.get(type(value))
+    if encoder:
+        return encoder(value)
+    elif isinstance(value, list):
+        if parent_is_list:
+            assert False,\
+                'ERROR: Nested lists are not available in Firestore.' 
+            return {'nullValue' : None}
+        return {'arrayValue' : {'values' : values(value)}}
+    elif isinstance(value, dict):
+        return {'mapValue' : {'fields' : fields(value)}}
+    for value_type, encoder in encoders.items():
+        # subclasses of the encoded types
+        if value_type is not type(None) and\
+           isinstance(value, value_type):
+            return encoder(value)
+    if isinstance(value, _BANNED_TYPES):
+        assert False, 'ERROR: ' + ref + 'value type ' +\
+            str(type(value)) + ' is not available in Firestore.' 
+        return {'nullValue' : None}
+    else:
+        assert False,\
+            'ERROR: Class ' + str(type(value)) +\
+            ' is not available in Firestore.'
+        return {'nullValue' : None}
+
+# Streaming encoder.
+# Rather than translate the whole dict and then serialize the translation,
+# the JSON encoder translates each dict or list as it reaches it.
+
+class _MapWrap:
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+class _ArrayWrap:
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+def fs_default(o):
+    if isinstance(o, _MapWrap):
+        return {str(key) : fs_value('Key "' + str(key) + '" ', value, False,
+                                    _MapWrap, _ArrayWrap, _FS_STREAM_ENCODERS)
+                for key, value in o.data.items()}
+    elif isinstance(o, _ArrayWrap):
+        return [fs_value('List Index [' + str(i) + '] ', value, True,
+                         _MapWrap, _ArrayWrap, _FS_STREAM_ENCODERS)
+                for i, value in enumerate(o.data)]
+    raise TypeError('Object of type ' + type(o).__name__ +\
+                    ' is not JSON serializable')
+
+class FirestoreEncoder(json.JSONEncoder):
+    def default(self, o):
+        return fs_default(o)
+
+_ENCODER = FirestoreEncoder(ensure_ascii=False, separators=(',', ':'))
+
+def encode_payload(request):
+    # request is a Firestore request body, with any data dict as
+    # 'fields' : _MapWrap(data)
+    if orjson:
+        # orjson replaces an exception raised by default with its own,
+        # keep the original which explains why a value can't be translated.
+        errors = []
+
+        def default(o):
+            try:
+                return fs_default(o)
+            except Exception as e:
+                errors.append(e)
+                raise
+
+        try:
+            return orjson.dumps(request, default = default)
+        except orjson.JSONEncodeError:
+            if errors:
+                raise errors[0]
+            raise
+    return _ENCODER.encode(request).encode('utf-8')
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+pytest.importorskip('requests')
+from firestore4kivy import Firestore
+
+
+class Response:
+    def __init__(self, status_code, body):
+        self.status_code = status_code
+        self.content = json.dumps(body).encode()
+
+
+class Session:
+    # Records the writes of each batchWrite, and reports them all written.
+    def __init__(self):
+        self.writes = []
+
+    def post(self, url, headers = None, data = None, timeout = None):
+        writes = json.loads(data)['writes']
+        self.writes.append(writes)
+        return Response(200, {'writeResults': [{'updateTime': 't'}] *
+                              len(writes),
+                              'status': [{}] * len(writes)})
+
+
+@pytest.fixture
+def db():
+    db = Firestore('project', http2 = False)
+    db.session = Session()
+    db.enable_database({'localId': 'user', 'idToken': 'token'})
+    return db
+
+
+def test_invalid_ops_fail_independently(db):
+    results = db.batch_write([('create', 'c', 'd1', {'a': 1}, ''),
+                              ('create', 'c', 'd2', {'bad': {1, 2}}, ''),
+                              ('create', 'c', 'd3', None, ''),
+                              ('delete', 'c', 'd4'),
+                              ('bogus', 'c', 'd5', {}, ''),
+                              ('delete', 'c', 'd6', None, '')])
+    assert results[0] == (True, {'a': 1}, 't')
+    assert [r[0] for r in results] == [True, False, False, False, False, True]
+    assert 'set' in results[1][1]
+    assert results[5] == (True, {}, 't')
+    assert len(db.session.writes) == 1
+    names = [w.get('delete') or w['update']['name']
+             for w in db.session.writes[0]]
+    assert [n.rsplit('/', 1)[-1] for n in names] == ['d1', 'd6']
+
+
+def test_atomic_commit_not_sent_with_an_invalid_op(db):
+    results = db.batch_write([('create', 'c', 'd1', {'a': 1}, ''),
+                              ('create', 'c', 'd2', {'bad': {1, 2}}, '')],
+                             atomic = True)
+    assert [r[0] for r in results] == [False, False]
+    assert db.session.writes == []
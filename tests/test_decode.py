@@ -0,0 +1,75 @@
+import pytest
+
+pytest.importorskip('requests')
+from firestore4kivy import Firestore, GeoPoint, TimeStamp, Reference
+
+
+@pytest.fixture
+def db():
+    return Firestore('project', http2 = False)
+
+
+def test_scalars(db):
+    data = db.dict_from_firestore({
+        'n': {'nullValue': None},
+        's': {'stringValue': 'text'},
+        'b': {'booleanValue': True},
+        'i': {'integerValue': '-42'},
+        'f': {'doubleValue': 1.5},
+        'y': {'bytesValue': 'abc'},
+        't': {'timestampValue': '2021-01-01T00:00:00Z'},
+        'r': {'referenceValue': 'projects/p/databases/(default)/documents/c/d'}})
+    t = data.pop('t')
+    r = data.pop('r')
+    assert data == {'n': None, 's': 'text', 'b': True, 'i': -42, 'f': 1.5,
+                    'y': b'abc'}
+    assert isinstance(t, TimeStamp) and t.get() == '2021-01-01T00:00:00Z'
+    assert isinstance(r, Reference) and\
+        r.get() == 'projects/p/databases/(default)/documents/c/d'
+
+
+def test_nested_map_and_array(db):
+    data = db.dict_from_firestore({
+        'm': {'mapValue': {'fields': {
+            'a': {'integerValue': '1'},
+            'm': {'mapValue': {'fields': {'b': {'stringValue': 'x'}}}},
+            'l': {'arrayValue': {'values': [
+                {'integerValue': '2'},
+                {'mapValue': {'fields': {'c': {'booleanValue': False}}}}]}}}}},
+        'l': {'arrayValue': {'values': [{'stringValue': 'y'},
+                                        {'doubleValue': 2.5}]}}})
+    assert data == {'m': {'a': 1, 'm': {'b': 'x'}, 'l': [2, {'c': False}]},
+                    'l': ['y', 2.5]}
+    assert list(data['m']) == ['a', 'm', 'l']
+
+
+def test_empty_values(db):
+    assert db.dict_from_firestore({}) == {}
+    assert db.dict_from_firestore({
+        'm': {'mapValue': {'fields': {}}},
+        'l': {'arrayValue': {'values': []}}}) == {'m': {}, 'l': []}
+
+
+def test_geopoint(db):
+    data = db.dict_from_firestore({
+        'g': {'geoPointValue': {'latitude': 1.5, 'longitude': -2.5}},
+        'l': {'arrayValue': {'values': [
+            {'geoPointValue': {'latitude': 3, 'longitude': 4}}]}}})
+    assert isinstance(data['g'], GeoPoint)
+    assert data['g'].get() == {'latitude': 1.5, 'longitude': -2.5}
+    assert data['l'][0].get() == {'latitude': 3, 'longitude': 4}
+
+
+def test_field_names_that_are_type_keywords(db):
+    data = db.dict_from_firestore({
+        'mapValue': {'mapValue': {'fields': {
+            'fields': {'stringValue': 'f'},
+            'stringValue': {'integerValue': '1'}}}},
+        'arrayValue': {'arrayValue': {'values': [{'stringValue': 'a'}]}},
+        'stringValue': {'stringValue': 's'},
+        'geoPointValue': {'mapValue': {'fields': {
+            'latitude': {'doubleValue': 1.0}}}}})
+    assert data == {'mapValue': {'fields': 'f', 'stringValue': 1},
+                    'arrayValue': ['a'],
+                    'stringValue': 's',
+                    'geoPointValue': {'latitude': 1.0}}
@@ -0,0 +1,53 @@
+import pytest
+
+pytest.importorskip('requests')
+from firestore4kivy import Firestore
+
+
+@pytest.fixture
+def db():
+    return Firestore('project', http2 = False)
+
+
+def test_pop_keys(db):
+    existing = {'a': 1, 'b': {'c': 2, 'd': 3}, 'e': 4}
+    db.dict_pop(existing, {'a': None, 'b': {'c': None}, 'x': None})
+    assert existing == {'b': {'d': 3}, 'e': 4}
+
+
+def test_pop_list_indices(db):
+    assert db.dict_pop([0, 1, 2, 3, 4], [(1, None), (3, None)]) == [0, 2, 4]
+    # Indices refer to the original list, in any order.
+    assert db.dict_pop([0, 1, 2, 3, 4], [(3, None), (1, None)]) == [0, 2, 4]
+    assert db.dict_pop([0, 1, 2], [(1, None), (1, None)]) == [0, 2]
+
+
+def test_pop_negative_index(db):
+    assert db.dict_pop([1, 2, 3], [(-1, None)]) == [1, 2]
+    assert db.dict_pop([1, 2, 3], [(-3, None)]) == [2, 3]
+    assert db.dict_pop([1, 2, 3], [(0, None), (-1, None)]) == [2]
+    # The same element by positive and negative index is dropped once.
+    assert db.dict_pop([1, 2, 3], [(2, None), (-1, None)]) == [1, 2]
+
+
+def test_pop_out_of_range_ignored(db):
+    assert db.dict_pop([1, 2, 3], [(3, None), (-4, None)]) == [1, 2, 3]
+    assert db.dict_pop([1, 2, 3], [(5, {'a': None})]) == [1, 2, 3]
+
+
+def test_pop_in_list_element(db):
+    existing = {'l': [{'a': 1, 'b': 2}, {'a': 3, 'b': 4}]}
+    db.dict_pop(existing, {'l': [(-1, {'a': None}), (0, None)]})
+    assert existing == {'l': [{'b': 4}]}
+
+
+def test_pop_list_without_tuples(db):
+    assert db.dict_pop([1, 2, 3], [1]) == []
+
+
+def test_replace_and_pop_agree_on_negative_index(db):
+    existing = [1, 2, 3]
+    db.dict_replace(existing, [(-1, 30)])
+    assert existing == [1, 2, 30]
+    db.dict_pop(existing, [(-1, None)])
+    assert existing == [1, 2]
@@ -0,0 +1,36 @@
+import json
+from enum import Enum
+
+import pytest
+
+pytest.importorskip('requests')
+from firestore4kivy import firestore4kivy as fs
+
+
+class Float(float):
+    pass
+
+class Str(str):
+    pass
+
+class Color(str, Enum):
+    RED = 'red'
+
+
+@pytest.fixture(params = ['orjson', 'json'])
+def encoder(request, monkeypatch):
+    # Run the write path with and without orjson.
+    if request.param == 'orjson':
+        pytest.importorskip('orjson')
+        assert fs.orjson
+    else:
+        monkeypatch.setattr(fs, 'orjson', None)
+    return fs.encode_payload
+
+
+def test_subclasses_encode_as_base_types(encoder):
+    data = {'f': Float(1.5), 's': Str('x'), 'c': Color.RED}
+    payload = json.loads(encoder({'fields' : fs._MapWrap(data)}))
+    assert payload == {'fields': {'f': {'doubleValue': 1.5},
+                                  's': {'stringValue': 'x'},
+                                  'c': {'stringValue': 'red'}}}
@@ -0,0 +1,19 @@
+import pytest
+
+pytest.importorskip('requests')
+from firestore4kivy import firestore4kivy as fs
+
+
+def test_take_within_capacity():
+    bucket = fs._TokenBucket(capacity = 2, refill = 1)
+    assert bucket.take() == 0
+    assert bucket.take(max_wait = 0) == 0
+
+
+def test_take_beyond_max_wait_takes_no_token():
+    bucket = fs._TokenBucket(capacity = 1, refill = 1)
+    bucket.take()
+    assert bucket.take(max_wait = 0.5) is None
+    # The refused take did not use a token, the next wait is still ~1s.
+    assert 0.9 < bucket.take(max_wait = 1.5) <= 1
+    assert 1.9 < bucket.take() <= 2